@@ -1,5 +1,7 @@
+import os
 import typing
 import uuid
+import array
 import asyncpg
 import logging
 import orjson
@@ -7,45 +9,266 @@ from rich.traceback import install as install_tb
 from rich.logging import RichHandler
 import asyncio
 
-from .events.base import EventHandler
+from .events.base import EventHandler, STATE_UPDATES
 from .net import Server, CONNECTIONS
 
 EVENT_HANDLERS: typing.Dict[str, typing.Type[EventHandler]] = dict()
 
-EVENTS: typing.Dict[uuid.UUID, EventHandler] = dict()
+# The run_cheap of every cheap event handler, so the dispatcher can call them without creating instances.
+CHEAP_HANDLERS: typing.Dict[str, typing.Callable[[dict], typing.Awaitable[None]]] = dict()
+
+# Values of Application.event_state.
+SLOT_FREE = 0
+SLOT_ACTIVE = 1
+SLOT_ABORTED = 2
+
+# Every insert into dbat.events, and every change to an event's state, is announced on this channel
+# as '<uuid>:<state>' so the Application only wakes up when there is work to do.
+EVENT_CHANNEL = "dbat_events"
+
+# Older databases store parameters as text; convert once so asyncpg's jsonb codec applies.
+PARAMETERS_JSONB_SQL = """
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = 'dbat' AND table_name = 'events' AND column_name = 'parameters') <> 'jsonb' THEN
+        ALTER TABLE dbat.events ALTER COLUMN parameters TYPE jsonb USING parameters::jsonb;
+    END IF;
+END
+$$;
+"""
+
+NOTIFY_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION dbat.notify_event() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{EVENT_CHANNEL}', NEW.id::text || ':' || NEW.current_state);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS events_notify ON dbat.events;
+CREATE TRIGGER events_notify
+    AFTER INSERT OR UPDATE OF current_state ON dbat.events
+    FOR EACH ROW EXECUTE FUNCTION dbat.notify_event();
+"""
+
+DRAIN_EVENTS_SQL = """
+SELECT id, event_name, parameters, current_state FROM dbat.events
+WHERE current_state IN ('finished', 'cancelled', 'error', 'pending')
+    AND ($1::uuid[] IS NULL OR id = ANY($1::uuid[]))
+FOR UPDATE SKIP LOCKED
+"""
+
+UPDATE_STATES_SQL = """
+UPDATE dbat.events SET current_state = v.state
+FROM unnest($1::uuid[], $2::text[]) AS v(id, state)
+WHERE dbat.events.id = v.id
+"""
+
+# Deletes the dead events ($1) and marks the new ones ($2) active in a single round trip.
+SETTLE_EVENTS_SQL = """
+WITH dead AS (DELETE FROM dbat.events WHERE id = ANY($1::uuid[]))
+UPDATE dbat.events SET current_state = 'active' WHERE id = ANY($2::uuid[])
+"""
+
+# Not locked: every worker needs to see these, since only the one running the event can cancel it.
+ABORTED_EVENTS_SQL = "SELECT id FROM dbat.events WHERE current_state = 'aborted'"
+
+DELETE_NONPERSISTENT_SQL = "DELETE FROM dbat.events WHERE persistent = FALSE"
+
+class EventConnection(asyncpg.Connection):
+    """
+    Connection which holds its own server-side prepared statements for the hottest event queries.
+    asyncpg's statement cache is disabled, so these are the only statements kept between queries.
+    Pool connections only write event states; the dispatcher's connection only drains.
+    """
+    __slots__ = ('drain_stmt', 'settle_stmt', 'update_states_stmt')
+    
+    async def prepare_pool_statements(self):
+        self.update_states_stmt = await self.prepare(UPDATE_STATES_SQL)
+    
+    async def prepare_dispatcher_statements(self):
+        self.drain_stmt = await self.prepare(DRAIN_EVENTS_SQL)
+        self.settle_stmt = await self.prepare(SETTLE_EVENTS_SQL)
+
+# jsonb's binary format is the JSON text prefixed with a version byte.
+JSONB_VERSION = b'\x01'
+
+def _encode_jsonb(value) -> bytes:
+    return JSONB_VERSION + orjson.dumps(value)
+
+def _decode_jsonb(data: bytes):
+    # Slicing a memoryview skips the version byte without copying the payload.
+    return orjson.loads(memoryview(data)[1:])
+
+async def _set_jsonb_codec(conn: asyncpg.Connection):
+    """
+    jsonb columns are decoded to Python objects by orjson. The codec is binary so that COPY can use it,
+    and must be in place before any statements are prepared.
+    """
+    await conn.set_type_codec('jsonb', encoder=_encode_jsonb, decoder=_decode_jsonb, schema='pg_catalog', format='binary')
+
+async def _init_pool_conn(conn: EventConnection):
+    """
+    Called once for every new pool connection.
+    """
+    await _set_jsonb_codec(conn)
+    await conn.prepare_pool_statements()
+
+# Pool settings, overridable through the "pool" object in dbconf.json.
+POOL_DEFAULTS = {
+    "min_size": 8,
+    "max_size": 32,
+    "max_inactive_connection_lifetime": 300.0,
+    "command_timeout": 30.0,
+}
 
 class Application:
     def __init__(self):
+        self._dbconf = None
         self.db_pool = None
+        self.listen_conn = None
         self.server = None
+        
+        # Running events, stored as parallel arrays indexed by slot.
+        self.event_ids: typing.List[typing.Optional[uuid.UUID]] = list()
+        self.event_tasks: typing.List[typing.Optional[asyncio.Task]] = list()
+        self.event_state = array.array('B')
+        self.id_to_slot: typing.Dict[uuid.UUID, int] = dict()
+        # Slots released by finished events, reused before the arrays grow.
+        self.free_slots: typing.List[int] = list()
+        # Payloads received on EVENT_CHANNEL, waiting to be dispatched by run().
+        # None means the dispatcher's connection was lost.
+        self._notify_queue = asyncio.Queue()
+        # The whole table is rescanned at least this often (in seconds), in case a notification was lost.
+        self.resync_interval = 5.0
+        # Loop time by which the next full rescan is due.
+        self.next_resync = 0.0
     
     def setup_logging(self):
-        install_tb()
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(message)s",
-            datefmt="[%X]",
-            handlers=[RichHandler()]
-        )
+        # Rich formats every record and traceback it sees, which is costly on busy servers.
+        # Set DBAT_RICH_LOG to use it anyway, e.g. while debugging.
+        if os.environ.get("DBAT_RICH_LOG"):
+            install_tb()
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(message)s",
+                datefmt="[%X]",
+                handlers=[RichHandler()]
+            )
+        else:
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(asctime)s %(levelname)s %(message)s",
+                datefmt="[%X]",
+                handlers=[logging.StreamHandler()]
+            )
 
     def register_event_handlers(self):
         from .events import connection
         
         for c in connection.__all__:
-            EVENT_HANDLERS[c] = getattr(connection, c)
+            cls = getattr(connection, c)
+            EVENT_HANDLERS[c] = cls
+            if cls.cheap:
+                CHEAP_HANDLERS[c] = cls.run_cheap
+    
+    def _load_dbconf(self) -> dict:
+        """
+        Reads dbconf.json once. It has dbname, user, password, and host fields, and optionally a "pool" object.
+        """
+        if self._dbconf is None:
+            with open("dbconf.json", "rb") as f:
+                self._dbconf = orjson.loads(f.read())
+        return self._dbconf
+    
+    def connect_settings(self) -> dict:
+        """
+        Connection keyword arguments for asyncpg. Passing them directly, rather than through a DSN,
+        means special characters in the password need no escaping.
+        """
+        settings = {k: v for k, v in self._load_dbconf().items() if k != "pool"}
+        # libpq (and so dbtool's psycopg2) calls it dbname; asyncpg calls it database.
+        settings["database"] = settings.pop("dbname")
+        return settings
     
-    def generate_dsn(self):
-        with open("dbconf.json") as f:
-            config = orjson.loads(f.read())
-            # it has dbname, user, password, and host fields.
-        return f"postgresql://{config['user']}:{config['password']}@{config['host']}/{config['dbname']}"
+    def pool_settings(self) -> dict:
+        return {**POOL_DEFAULTS, **self._load_dbconf().get("pool", dict())}
     
     async def setup_db(self):
-        dsn = self.generate_dsn()
-        self.db_pool = await asyncpg.create_pool(dsn)
+        connect_settings = self.connect_settings()
+        conn = await asyncpg.connect(**connect_settings)
+        try:
+            await conn.execute(PARAMETERS_JSONB_SQL)
+            await conn.execute(NOTIFY_TRIGGER_SQL)
+        finally:
+            await conn.close()
+        await self.connect_dispatcher()
+        self.db_pool = await asyncpg.create_pool(
+            **connect_settings,
+            # The hot statements are prepared explicitly in init, so asyncpg's own cache would only hold one-shot queries.
+            # Those named statements live on the server backend, so this pool must not sit behind a
+            # transaction-mode pooler such as PgBouncer.
+            statement_cache_size=0,
+            max_cacheable_statement_size=0,
+            connection_class=EventConnection,
+            init=_init_pool_conn,
+            **self.pool_settings()
+        )
+    
+    async def connect_dispatcher(self):
+        """
+        Opens the dispatcher's connection. LISTEN needs a long-lived connection of its own, since pooled
+        connections UNLISTEN when released. It also runs every drain, leaving the whole pool to event handlers.
+        """
+        conn = await asyncpg.connect(**self.connect_settings(), statement_cache_size=0, connection_class=EventConnection)
+        try:
+            await _set_jsonb_codec(conn)
+            await conn.prepare_dispatcher_statements()
+            await conn.add_listener(EVENT_CHANNEL, self._on_event_notify)
+        except BaseException:
+            conn.terminate()
+            raise
+        conn.add_termination_listener(self._on_dispatcher_lost)
+        self.listen_conn = conn
+    
+    async def reconnect_dispatcher(self):
+        """
+        Replaces a lost dispatcher connection, retrying until it succeeds.
+        Anything announced while we were disconnected was missed, so a full rescan follows.
+        """
+        if self.listen_conn:
+            self.listen_conn.remove_termination_listener(self._on_dispatcher_lost)
+            self.listen_conn.terminate()
+        while True:
+            try:
+                await self.connect_dispatcher()
+                break
+            except (OSError, asyncpg.InterfaceError, asyncpg.PostgresError) as e:
+                logging.error(f"Could not reconnect dispatcher: {e}")
+                await asyncio.sleep(self.resync_interval)
+        while not self._notify_queue.empty():
+            self._notify_queue.get_nowait()
+        self.next_resync = 0.0
+        logging.info("Dispatcher reconnected.")
+    
+    def _on_event_notify(self, connection, pid, channel, payload):
+        self._notify_queue.put_nowait(payload)
+    
+    def _on_dispatcher_lost(self, connection):
+        self._notify_queue.put_nowait(None)
         
+    def setup_task_factory(self):
+        """
+        Run new tasks eagerly, up to their first await, instead of waiting a loop iteration to start.
+        Events, connections, and their readers and writers are all started with create_task().
+        """
+        if hasattr(asyncio, "eager_task_factory"):
+            asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    
     async def setup(self, host: str, port: int):
         self.setup_logging()
+        self.setup_task_factory()
         self.register_event_handlers()
         await self.setup_db()
         self.server = Server(host, port, self.db_pool)
@@ -56,6 +279,8 @@ class Application:
             async with asyncio.TaskGroup() as tg:
                 tg.create_task(self.server.start())
                 tg.create_task(self.run())
+                tg.create_task(self.write_states())
+                tg.create_task(self.server.submit_commands())
         except asyncio.CancelledError:
             logging.info("Application cancelled.")
         except BaseExceptionGroup as e:
@@ -66,67 +291,172 @@ class Application:
             logging.critical("Shutting down...")
 
     async def run(self):
+        loop = asyncio.get_running_loop()
         try:
             await self.cleanup_nonpersistent_events()
             while True:
-                await self.execute_aborts()
-                await self.cleanup_events()
-                await self.execute_events()
-                await asyncio.sleep(0.08)
+                try:
+                    # Rescan the whole table every so often, however busy we are, in case a notification was lost.
+                    if (timeout := self.next_resync - loop.time()) <= 0:
+                        await self.drain_events()
+                        continue
+                    try:
+                        payload = await asyncio.wait_for(self._notify_queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        continue
+                    if payload is None:
+                        logging.error("Dispatcher connection lost.")
+                        await self.reconnect_dispatcher()
+                    elif (ids := self.collect_notified_ids(payload)):
+                        await self.drain_events(ids)
+                except (OSError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError) as e:
+                    logging.error(f"Dispatcher connection failed: {e}")
+                    await self.reconnect_dispatcher()
         except asyncio.CancelledError:
             logging.info("Application run cancelled.")
     
+    async def write_states(self):
+        """
+        Writes the states queued by event handlers whose own transaction was rolled back,
+        batching everything that has queued up into a single UPDATE.
+        If the UPDATE fails, the batch is kept and retried along with anything queued since.
+        """
+        updates = dict()
+        try:
+            while True:
+                if not updates:
+                    event_id, state = await STATE_UPDATES.get()
+                    updates[event_id] = state
+                # Later states for the same event replace earlier ones.
+                while not STATE_UPDATES.empty():
+                    event_id, state = STATE_UPDATES.get_nowait()
+                    updates[event_id] = state
+                try:
+                    async with self.db_pool.acquire() as conn:
+                        await conn.update_states_stmt.fetch(list(updates.keys()), list(updates.values()))
+                except (OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresError) as e:
+                    logging.error(f"Could not write {len(updates)} event states, retrying: {e}")
+                    await asyncio.sleep(self.resync_interval)
+                    continue
+                updates.clear()
+        except asyncio.CancelledError:
+            logging.info("State writer cancelled.")
+    
+    def collect_notified_ids(self, payload: str) -> typing.List[uuid.UUID]:
+        """
+        Gathers the ids from the given notification and any others that have queued up behind it.
+        Aborted events are cancelled right away, if they're running here.
+        Events which were merely marked 'active' need no attention.
+        """
+        payloads = [payload]
+        while not self._notify_queue.empty():
+            payloads.append(self._notify_queue.get_nowait())
+        
+        ids = list()
+        for p in payloads:
+            if p is None:
+                # The connection dropped; the full rescan after reconnecting will pick these up anyway.
+                self._notify_queue.put_nowait(None)
+                return list()
+            event_id, _, state = p.partition(":")
+            match state:
+                case "active":
+                    pass
+                case "aborted":
+                    self.abort_event(uuid.UUID(event_id))
+                case _:
+                    ids.append(uuid.UUID(event_id))
+        return ids
+    
     async def cleanup_nonpersistent_events(self):
         async with self.db_pool.acquire() as conn:
             async with conn.transaction():
-                await conn.execute("DELETE FROM dbat.events WHERE persistent = FALSE")
+                await conn.execute(DELETE_NONPERSISTENT_SQL)
     
-    async def execute_aborts(self):
+    async def drain_events(self, ids: typing.Optional[typing.List[uuid.UUID]] = None):
         """
-        For every event in dbat.events where state is 'aborted', get event from EVENTS and call ev.task.cancel()
+        Handles every event that needs attention in a single transaction, then starts any new events.
+        If ids is given, only those events are considered; otherwise this is a full rescan.
         """
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                async for record in conn.cursor("SELECT id FROM dbat.events WHERE current_state = 'aborted'"):
-                    if (ev := EVENTS.get(record['id'])):
-                        ev.task.cancel()
+        if ids is None:
+            self.next_resync = asyncio.get_running_loop().time() + self.resync_interval
+            for record in await self.listen_conn.fetch(ABORTED_EVENTS_SQL):
+                self.abort_event(record['id'])
+        async with self.listen_conn.transaction():
+            new_events = await self._drain_events(self.listen_conn, ids)
+        
+        # Now that the transaction's complete, start 'em up.
+        for ev in new_events:
+            ev.start()
+            self.add_event(ev)
+    
+    def add_event(self, ev: EventHandler):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.event_ids[slot] = ev.id
+            self.event_tasks[slot] = ev.task
+            self.event_state[slot] = SLOT_ACTIVE
+        else:
+            slot = len(self.event_ids)
+            self.event_ids.append(ev.id)
+            self.event_tasks.append(ev.task)
+            self.event_state.append(SLOT_ACTIVE)
+        self.id_to_slot[ev.id] = slot
+        # Only the worker running an event knows about its slot, so it's released here rather than by
+        # whichever worker happens to delete the row.
+        ev.task.add_done_callback(lambda task, event_id=ev.id: self.release_event(event_id))
     
-    async def cleanup_events(self):
+    def abort_event(self, event_id: uuid.UUID):
         """
-        For every event marked finished, cancelled, or error, remove the event from EVENTS if it exists.
-        Then delete it from the database.
+        Cancels the event's task, if it's running here and hasn't been cancelled already.
         """
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                async for record in conn.cursor("SELECT id, current_state FROM dbat.events WHERE current_state IN ('finished', 'cancelled', 'error')"):
-                    EVENTS.pop(record['id'], None)
-                    await conn.execute("DELETE FROM dbat.events WHERE id = $1", record['id'])
+        if (slot := self.id_to_slot.get(event_id, None)) is not None and self.event_state[slot] == SLOT_ACTIVE:
+            self.event_state[slot] = SLOT_ABORTED
+            self.event_tasks[slot].cancel()
     
-    async def execute_events(self):
+    def release_event(self, event_id: uuid.UUID):
+        if (slot := self.id_to_slot.pop(event_id, None)) is not None:
+            self.event_ids[slot] = None
+            self.event_tasks[slot] = None
+            self.event_state[slot] = SLOT_FREE
+            self.free_slots.append(slot)
+    
+    async def _drain_events(self, conn: EventConnection, ids: typing.Optional[typing.List[uuid.UUID]] = None) -> typing.List[EventHandler]:
         """
-        For every event in dbat.events where current_state is 'pending', retrieve the uuid, event_name, and parameters. Mark state as 'active'
-        Then create instance of proper event handler and call start() on it.
+        Events marked finished, cancelled, or error are deleted from the database.
+        Events in state 'pending' get an instance of the proper event handler and are marked 'active'.
+        Cheap events are run right here instead, and deleted once done.
+        
+        Rows locked by another worker are skipped, so each pending event is started by exactly one Application.
+        Returns the new event handlers, which have not been started yet.
         """
         new_events = list()
-        bad_event_uuids = list()
+        dead_event_uuids = list()
         new_event_uuids = list()
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                async for record in conn.cursor("SELECT id, event_name, parameters FROM dbat.events WHERE current_state = 'pending'"):
-                    if (handler_class := EVENT_HANDLERS.get(record['event_name'], None)):
-                        uu = record['id']
-                        ev = handler_class(uu, orjson.loads(record['parameters'].encode()), self.db_pool)
+        get_cheap = CHEAP_HANDLERS.get
+        get_handler = EVENT_HANDLERS.get
+        for record in await conn.drain_stmt.fetch(ids):
+            uu = record['id']
+            match record['current_state']:
+                case "pending":
+                    event_name = record['event_name']
+                    if (run_cheap := get_cheap(event_name, None)):
+                        try:
+                            await run_cheap(record['parameters'])
+                        except Exception as e:
+                            logging.error(f"Error in cheap event {event_name} ({uu}): {e}")
+                        # Finished events would only be deleted on the next drain, so skip straight to that.
+                        dead_event_uuids.append(uu)
+                    elif (handler_class := get_handler(event_name, None)):
+                        ev = handler_class(uu, record['parameters'], self.db_pool)
                         new_event_uuids.append(uu)
                         new_events.append(ev)
                     else:
-                        logging.error(f"Event {record['event_name']} not found.")
-                        bad_event_uuids.append(record['id'])
-                    if bad_event_uuids:
-                        await conn.execute("DELETE FROM dbat.events WHERE id = ANY($1)", bad_event_uuids)
-                    if new_event_uuids:
-                        await conn.execute("UPDATE dbat.events SET current_state = 'active' WHERE id = ANY($1)", new_event_uuids)
+                        logging.error(f"Event {event_name} not found.")
+                        dead_event_uuids.append(uu)
+                case _:
+                    dead_event_uuids.append(uu)
         
-        # Now that the transaction's complete and the pool has been released, start 'em up.
-        for ev in new_events:
-            EVENTS[ev.id] = ev
-            ev.start()
+        if dead_event_uuids or new_event_uuids:
+            await conn.settle_stmt.fetch(dead_event_uuids, new_event_uuids)
+        return new_events
@@ -2,6 +2,10 @@ import asyncio
 import uuid
 import asyncpg
 
+MARK_STATE_SQL = "UPDATE dbat.events SET current_state = $1 WHERE id = $2"
+
+# (event id, new state) pairs for events whose own transaction is gone. Application writes these in batches.
+STATE_UPDATES: asyncio.Queue = asyncio.Queue()
 
 class EventHandler:
     """
@@ -12,6 +16,10 @@ class EventHandler:
         """Custom exception class for handling specific event errors."""
         pass
     
+    # Cheap events are run inline by the dispatcher, while it holds its transaction open, instead of getting a task.
+    # They must be quick, cannot be aborted, and get no connection: they must not touch the database.
+    cheap: bool = False
+    
     def __init__(self, id: uuid.UUID, parameters: dict, db_pool: asyncpg.Pool):
         self.id = id
         self.parameters = parameters
@@ -40,13 +48,13 @@ class EventHandler:
                     except Exception as e:
                         raise self.EventError(f"Unhandled exception during event processing: {e}")
         except asyncio.CancelledError:
-            await self._mark_state("cancelled")
+            self._queue_state("cancelled")
         except self.EventError:
-            await self._mark_state("error")
+            self._queue_state("error")
         except Exception as e:
             # Handle any unexpected errors that should also abort the event
             print(f"Unexpected error in EventHandler {self.id}: {e}")
-            await self._mark_failed("error")
+            self._queue_state("error")
     
     async def run(self, conn: asyncpg.Connection):
         """
@@ -55,12 +63,26 @@ class EventHandler:
         If this function raises an exception that reaches the calling method, the transaction will be aborted.
         If it reaches the end successfully, the transaction will be committed. 
         """
+        if self.cheap:
+            await self.run_cheap(self.parameters)
+    
+    @staticmethod
+    async def run_cheap(parameters: dict):
+        """
+        Main logic of a cheap event. Cheap events override this instead of run(),
+        so the dispatcher can call it without creating an instance.
+        """
         pass
     
-    async def _mark_state(self, new_state: str):
+    async def _mark_state(self, conn: asyncpg.Connection, new_state: str):
+        """
+        Sets the event state in the database, using the connection (and transaction) the event ran in.
+        """
+        await conn.execute(MARK_STATE_SQL, new_state, self.id)
+    
+    def _queue_state(self, new_state: str):
         """
-        This method is called if the event fails.
-        It sets the event state to 'failed' in the database.
+        This method is called if the event fails or is cancelled, after its transaction has been rolled back.
+        The new state is written later, batched with any others, so no extra pool connection is needed here.
         """
-        async with self.db_pool.acquire() as conn:
-            await conn.execute("UPDATE dbat.events SET current_state = $1 WHERE id = $2", new_state, self.id)
\ No newline at end of file
+        STATE_UPDATES.put_nowait((self.id, new_state))
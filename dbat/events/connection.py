@@ -6,8 +6,11 @@ class ClientSubmittedCommand(EventHandler):
     Event handler for when a client sends a command to the server.
     """
     
-    async def run(self, conn):
-        logging.info(f"Command from conn ({self.parameters['conn_id']}): {self.parameters['command']}")
+    cheap = True
+    
+    @staticmethod
+    async def run_cheap(parameters):
+        logging.info("Command from conn (%s): %s", parameters['conn_id'], parameters['command'])
 
 
 class ClientConnected(EventHandler):
@@ -15,8 +18,11 @@ class ClientConnected(EventHandler):
     Event handler for when a client sends a command to the server.
     """
     
-    async def run(self, conn):
-        logging.info(f"Client connected: {self.parameters['conn_id']}")
+    cheap = True
+    
+    @staticmethod
+    async def run_cheap(parameters):
+        logging.info("Client connected: %s", parameters['conn_id'])
 
 
 class ClientDisconnected(EventHandler):
@@ -24,8 +30,11 @@ class ClientDisconnected(EventHandler):
     Event handler for when a client has disconnected unexpectedly.
     """
     
-    async def run(self, conn):
-        logging.info(f"Client disconnected: {self.parameters['conn_id']}")
+    cheap = True
+    
+    @staticmethod
+    async def run_cheap(parameters):
+        logging.info("Client disconnected: %s", parameters['conn_id'])
 
 
 __all__ = ["ClientSubmittedCommand", "ClientConnected", "ClientDisconnected"]
\ No newline at end of file
@@ -2,7 +2,9 @@ import asyncio
 import uuid
 import typing
 import orjson
+import asyncpg
 import logging
+from collections import deque
 
 class OutMessage:
     """
@@ -20,7 +22,7 @@ class Connection:
     Basic class which represents a game connection.
     """
     
-    __slots__ = ['server', 'conn_id', 'reader', 'writer', 'task', 'out_queue', 'pending_commands', 'closed_by_client', 'closed_by_server']
+    __slots__ = ['server', 'conn_id', 'reader', 'writer', 'task', 'out_buf', 'out_event', 'pending_commands', 'closed_by_client', 'closed_by_server']
     
     def __init__(self, server, conn_id: uuid.UUID, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         self.server = server
@@ -29,8 +31,9 @@ class Connection:
         self.writer = writer
         self.task = None
         
-        # Holds instances of OutMessages.
-        self.out_queue = asyncio.Queue()
+        # Holds instances of OutMessages. out_event is set whenever something is added.
+        self.out_buf = deque()
+        self.out_event = asyncio.Event()
         
         # commands read from the incoming reader.
         self.pending_commands = []
@@ -41,6 +44,10 @@ class Connection:
     def start(self):
         self.task = asyncio.create_task(self.run())
     
+    def send(self, message: OutMessage):
+        self.out_buf.append(message)
+        self.out_event.set()
+    
     async def close(self):
         self.closed_by_server = True
         self.task.cancel()
@@ -59,59 +66,72 @@ class Connection:
         finally:
             self.writer.close()
             DEAD_CONNECTIONS[self.conn_id] = CONNECTIONS.pop(self.conn_id)
-            del NEW_CONNECTIONS[self.conn_id]
+            NEW_CONNECTIONS.discard(self.conn_id)
         await self.writer.wait_closed()
 
 
     async def run_reader(self):
-        in_buffer = bytearray()
+        # Set when a line overflowed the reader's limit. The rest of that line is thrown away too.
+        overlong = False
         try:
             while True:
-                data = await self.reader.read(1024)  # Adjust the read size as appropriate
-                if not data:
+                try:
+                    data = await self.reader.readuntil(b'\r\n')
+                except asyncio.IncompleteReadError:
                     # EOF reached or connection closed
                     self.closed_by_client = True
                     self.task.cancel()
                     break
+                except asyncio.LimitOverrunError as e:
+                    await self.reader.readexactly(e.consumed)
+                    overlong = True
+                    continue
                 
-                in_buffer.extend(data)
+                if overlong:
+                    overlong = False
+                    continue
                 
-                while b'\r\n' in in_buffer:
-                    # Find the position of the first occurrence of \r\n
-                    line_end_pos = in_buffer.find(b'\r\n')
-                    
-                    # Extract the line without stripping leading whitespace
-                    line = in_buffer[:line_end_pos].decode('utf-8', errors='ignore')
-                    
-                    # Remove the processed line and \r\n from the buffer. We can use the del operator.
-                    del in_buffer[:line_end_pos + 2]
-                    
-                    # Fire off the complete line
-                    self.pending_commands.append(line)
-                    PENDING_COMMANDS.add(self.conn_id)
+                # Fire off the complete line, without the \r\n and without stripping leading whitespace
+                self.pending_commands.append(data[:-2].decode('utf-8', errors='ignore'))
+                PENDING_COMMANDS.add(self.conn_id)
+                COMMANDS_READY.set()
                     
         except asyncio.CancelledError:
             pass
     
     async def run_writer(self):
         """
-        Continuously writes messages from the out_queue to the StreamWriter.
+        Continuously writes messages from out_buf to the StreamWriter.
+        Everything queued up since the last wakeup is handed over in one writelines() and shares a single drain().
         """
         while True:
-            message: OutMessage = await self.out_queue.get()
-            if message.flags == 0:
-                self.writer.write(message.data)
-            # Add any flag-based behavior here (e.g., special handling based on message.flags)
+            await self.out_event.wait()
+            self.out_event.clear()
+            data = list()
+            close = False
+            while self.out_buf:
+                message: OutMessage = self.out_buf.popleft()
+                if message.flags == 0:
+                    data.append(message.data)
+                # Add any flag-based behavior here (e.g., special handling based on message.flags)
+                if message.flags:
+                    close = True
+                    break
+            if data:
+                self.writer.writelines(data)
             await self.writer.drain()  # Ensure data is sent
-            self.out_queue.task_done()  # Mark task as done
-            if message.flags:
+            if close:
                 self.task.cancel()
 
 # dict[uuid, Connection]
 CONNECTIONS: typing.Dict[uuid.UUID, Connection] = dict()
 NEW_CONNECTIONS: typing.Set[uuid.UUID] = set()
-DEAD_CONNECTIONS: typing.Dict[uuid.UUID, Connection] = set()
+DEAD_CONNECTIONS: typing.Dict[uuid.UUID, Connection] = dict()
 PENDING_COMMANDS: typing.Set[uuid.UUID] = set()
+# Set whenever a connection adds to PENDING_COMMANDS.
+COMMANDS_READY = asyncio.Event()
+
+EVENT_COLUMNS = ["id", "event_name", "parameters", "current_state", "persistent"]
 
 class Server:
     """
@@ -122,12 +142,50 @@ class Server:
         self.port = port
         self.server = None
         self.db_pool = db_pool
+        # Seconds to wait before retrying a failed COPY of submitted commands.
+        self.retry_interval = 5.0
 
     async def start(self):
-        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        # limit caps how long a single line may be before run_reader discards it.
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port, limit=65536)
         addr = self.server.sockets[0].getsockname()
         logging.info(f'Serving on {addr}')
 
+    async def submit_commands(self):
+        """
+        Turns the commands read from every connection into ClientSubmittedCommand events.
+        Everything that arrived since the last batch is written with a single COPY.
+        If the COPY fails, the batch is kept and retried along with anything that has arrived since.
+        """
+        records = list()
+        try:
+            while True:
+                if not records:
+                    await COMMANDS_READY.wait()
+                COMMANDS_READY.clear()
+                
+                while PENDING_COMMANDS:
+                    conn_id = PENDING_COMMANDS.pop()
+                    # A client that has just disconnected may still have lines waiting, e.g. a final 'quit'.
+                    if not (conn := CONNECTIONS.get(conn_id, None) or DEAD_CONNECTIONS.get(conn_id, None)):
+                        continue
+                    str_id = str(conn_id)
+                    for command in conn.pending_commands:
+                        records.append((uuid.uuid4(), "ClientSubmittedCommand", {"conn_id": str_id, "command": command}, "pending", False))
+                    conn.pending_commands.clear()
+                
+                if records:
+                    try:
+                        async with self.db_pool.acquire() as conn:
+                            await conn.copy_records_to_table("events", records=records, columns=EVENT_COLUMNS, schema_name="dbat")
+                    except (OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresError) as e:
+                        logging.error(f"Could not submit {len(records)} commands, retrying: {e}")
+                        await asyncio.sleep(self.retry_interval)
+                        continue
+                    records.clear()
+        except asyncio.CancelledError:
+            pass
+
     def handle_client(self, reader, writer):
         conn_id = uuid.uuid4()
         conn = Connection(self, conn_id, reader, writer)
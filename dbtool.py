@@ -4,15 +4,16 @@ from pathlib import Path
 import os
 import orjson
 import psycopg2
+import psycopg2.extras
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 json = orjson
 
 
 def readJsonFile(dump_dir: Path, file_name: str):
-    with open(dump_dir / file_name) as f:
-        data = json.loads(f.read())
-    return data
+    # orjson parses bytes directly, so there's no need to decode the file to text first.
+    return json.loads((dump_dir / file_name).read_bytes())
 
 def tool_index_obj_apply(dump_dir: Path, args):
     location = int(args[0])
@@ -24,8 +25,8 @@ def tool_index_obj_apply(dump_dir: Path, args):
     for proto in data:
         affect = []
 
-        for aff in proto.get("affected", list()):
-            if (loc := aff.pop("location", -1)) == location:
+        for aff in proto.get("affected", ()):
+            if aff.get("location", -1) == location:
                 affect.append(aff)
 
         if affect:
@@ -46,7 +47,7 @@ def tool_index_obj_flag(dump_dir: Path, args):
     total = 0
     for proto in data:
 
-        if flag in set(proto.get("extra_flags", list())):
+        if flag in proto.get("extra_flags", ()):
             total += 1
             print(f"VN: {proto['vn']} - {proto['name']}")
 
@@ -54,6 +55,8 @@ def tool_index_obj_flag(dump_dir: Path, args):
 
 def tool_load_sql(dump_dir: Path, args):
     sql_data = readJsonFile(Path.cwd(), "dbconf.json")
+    # The game server's pool settings aren't connection parameters.
+    sql_data.pop("pool", None)
     conn = psycopg2.connect(**sql_data)
     
     cur = conn.cursor()
@@ -68,8 +71,8 @@ def tool_load_sql(dump_dir: Path, args):
         rooms.add(j.get("id"))
         data_to_insert.append((j.get("id"), j.get("name")))
     
-    sql = """INSERT INTO dbat.rooms (id, name) VALUES (%s, %s)"""
-    cur.executemany(sql, data_to_insert)
+    sql = """INSERT INTO dbat.rooms (id, name) VALUES %s"""
+    psycopg2.extras.execute_values(cur, sql, data_to_insert, page_size=1000)
     
     data_to_insert.clear()
     for j in readJsonFile(dump_dir, "exits.json"):
@@ -83,8 +86,8 @@ def tool_load_sql(dump_dir: Path, args):
                     continue
                 data_to_insert.append((room, direction, dest))
     
-    sql = """INSERT INTO dbat.exits (room, direction, destination) VALUES (%s, %s, %s)"""
-    cur.executemany(sql, data_to_insert)
+    sql = """INSERT INTO dbat.exits (room, direction, destination) VALUES %s"""
+    psycopg2.extras.execute_values(cur, sql, data_to_insert, page_size=1000)
     
     conn.commit()
     
@@ -93,11 +96,12 @@ def tool_load_sql(dump_dir: Path, args):
     conn.close()
 
 def tool_load_all(dump_path: Path, *args):
-    data = dict()
     start_time = time.time()
-    for file in dump_path.iterdir():
-        if file.is_file():
-            data[file.stem] = readJsonFile(dump_path, file.name)
+    files = [file for file in dump_path.iterdir() if file.is_file()]
+    # Threads let the file reads overlap.
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        loaded = ex.map(lambda file: readJsonFile(dump_path, file.name), files)
+        data = dict(zip((file.stem for file in files), loaded))
     end_time = time.time()
     print(f"Loaded {len(data)} files in {end_time - start_time} seconds.")
     # wait for console input.
@@ -3,6 +3,12 @@
 import asyncio
 from dbat.core import Application
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop isn't available on Windows; the default loop works, just slower.
+    uvloop = None
+
 
 async def main():
     app = Application()
@@ -10,4 +16,7 @@ async def main():
     await app.start()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file